@@ -5,11 +5,19 @@ CLI utility that visualises corporate structure and quantity of land ownership.
 import argparse
 import collections
 import csv
-from typing import Dict, IO, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Type
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Dict, IO, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+# Read input files in large chunks, so the CSV parser isn't stalled on a read syscall
+# every few kilobytes. Parsing, not reading, dominates load time: mmap-ing the files
+# saves a copy, but wrapping the mapped text for the csv module costs more than that.
+READ_BUFFER_SIZE = 4 << 20  # 4 MiB
 
 
 class Company:
-    __slots__ = ("_parent_id", "id", "name", "children_ids")
+    __slots__ = ("parent_id", "_root", "id", "name", "children_ids")
 
     def __init__(
         self,
@@ -19,19 +27,14 @@ class Company:
         children_ids: Optional[List[str]] = None,
     ):
         self.id = id
-        self.parent_id = parent_id
+        # Guard against "" being stored as parent_id. Checked once here rather than
+        # in a property, so later writes (e.g. while parsing) cost a plain slot store.
+        # Assumption: ""/None means this company is a top-level parent itself.
+        self.parent_id = parent_id or None
         self.name = name
         self.children_ids = [] if children_ids is None else children_ids
-
-    @property
-    def parent_id(self):
-        return self._parent_id
-
-    @parent_id.setter
-    def parent_id(self, new_id):
-        # This setter is here to guard against "" being set as parent_id.
-        # Assumption: ""/None means this company is a top-level parent itself.
-        self._parent_id = None if not new_id else new_id
+        # Cache for get_root_company_id. Only ever set on companies with a parent.
+        self._root = None
 
 
 def get_company_relations(data_file: IO) -> Dict[str, Company]:
@@ -44,40 +47,37 @@ def get_company_relations(data_file: IO) -> Dict[str, Company]:
     Assumption: a parent of "" indicates no parent, i.e. a top-level company.
     """
     result = {}
-    company_relation_type = collections.namedtuple(
-        "company_relation", "company_id,name,parent"
-    )
 
-    # Discard header line. Pass the primed file to read_csv.
-    next(data_file)
-    for record in read_csv(data_file, company_relation_type):
-        # Records may refer to a parent which we haven't seen yet.
-        try:
-            parent = result[record.parent]
-        except KeyError:
-            # Create new Company instance if we haven't seen this parent yet.
-            # We can't know its name or parent yet. We'll update those later.
-            # Note: only do this for an actual parent (i.e. parent ID is non-empty).
-            if record.parent:
-                result[record.parent] = Company(
-                    id=record.parent, children_ids=[record.company_id]
-                )
-        else:
-            # Update existing instance if a child has already referenced it previously.
-            parent.children_ids.append(record.company_id)
+    for company_id, name, parent_id in read_csv(data_file, ("company_id", "name", "parent")):
+        # Each ID is stored several times (as a key, on the Company and in its
+        # parent's children_ids). Interning shares one string object between them
+        # and lets later dict lookups match by identity.
+        company_id = sys.intern(company_id)
+        # As in Company.__init__, "" means no parent. Normalised here too, since
+        # the update below writes parent_id on an existing Company directly.
+        parent_id = sys.intern(parent_id) or None
 
-        # Similarly the current record may be a parent from the above except-statement.
-        try:
-            company = result[record.company_id]
-        except KeyError:
+        # Records may refer to a parent which we haven't seen yet.
+        # Note: only do this for an actual parent (i.e. parent ID is non-empty).
+        if parent_id:
+            parent = result.get(parent_id)
+            if parent is None:
+                # Create new Company instance if we haven't seen this parent yet.
+                # We can't know its name or parent yet. We'll update those later.
+                result[parent_id] = Company(id=parent_id, children_ids=[company_id])
+            else:
+                # Update existing instance if a child has already referenced it previously.
+                parent.children_ids.append(company_id)
+
+        # Similarly the current record may be a parent created above for an earlier record.
+        company = result.get(company_id)
+        if company is None:
             # Create new Company instance for the current record.
-            result[record.company_id] = Company(
-                id=record.company_id, name=record.name, parent_id=record.parent
-            )
+            result[company_id] = Company(id=company_id, name=name, parent_id=parent_id)
         else:
             # Update an existing record (a company that was referred to as a parent previously).
-            company.name = record.name
-            company.parent_id = record.parent
+            company.name = name
+            company.parent_id = parent_id
 
     return result
 
@@ -88,20 +88,50 @@ def get_land_ownership(data_file: IO) -> Dict[str, List[str]]:
     {company_id: [land_id, ...]}
     """
     result = collections.defaultdict(list)
-    company_land_type = collections.namedtuple("company_land", "land_id,company_id")
 
-    # Discard header line. Pass the primed file to read_csv.
-    next(data_file)
-    for record in read_csv(data_file, company_land_type):
-        result[record.company_id].append(record.land_id)
+    for land_id, company_id in read_csv(data_file, ("land_id", "company_id")):
+        result[company_id].append(land_id)
 
     return result
 
 
-def read_csv(file: IO, structure: Type[NamedTuple]) -> Iterator[NamedTuple]:
-    """Read open CSV file into a generator of named tuples."""
+def open_csv(path: str) -> IO:
+    """
+    Open a CSV file for reading with a large read buffer.
+    newline="" lets the csv module handle line endings itself, as it expects.
+    """
+    return open(path, newline="", buffering=READ_BUFFER_SIZE)
+
+
+def load_data(
+    relations_path: str, land_path: str
+) -> Tuple[Dict[str, Company], Dict[str, List[str]]]:
+    """
+    Load both input files, opening and parsing each exactly once:
+    ({company_id: Company}, {company_id: [land_id, ...]})
+    """
+    with open_csv(relations_path) as f:
+        companies = get_company_relations(f)
+
+    with open_csv(land_path) as f:
+        company_land = get_land_ownership(f)
+
+    return companies, company_land
+
+
+def read_csv(file: IO, header: Sequence[str]) -> Iterator[List[str]]:
+    """
+    Read open CSV file into an iterator of rows, each a list of fields.
+    The header line is consumed and checked against `header` up front, so callers
+    can unpack rows by position without re-checking column order on every row.
+    Raises ValueError if the header line does not match.
+    """
     reader = csv.reader(file)
-    return (structure(*line) for line in reader)
+    found = next(reader, [])
+    if found != list(header):
+        raise ValueError(f"Expected CSV header {list(header)}, found {found}")
+
+    return reader
 
 
 def parse_args(argv: List[str]) -> argparse.Namespace:
@@ -120,13 +150,151 @@ def get_root_company_id(company_id: str, companies: Mapping[str, Company]) -> st
     """
     Get the top-level parent in the company tree for a given child company_id.
     If the company has no parents, then the original company_id is returned.
+    Raises ValueError if the parent chain contains a cycle (a company owning its own ancestor).
     """
     company = companies[company_id]
+    path = []
+
+    # Walk up iteratively, stopping early at a company whose root is already known.
+    while company._root is None and company.parent_id is not None:
+        path.append(company)
+        # A chain can't be longer than the number of companies: any longer means
+        # the walk has gone round a cycle and would never reach a root.
+        if len(path) > len(companies):
+            raise ValueError(f"Parent chain of company {company_id} contains a cycle")
+        company = companies[company.parent_id]
+
+    root_company_id = company._root or company.id
+
+    # Path compression: remember the root on every company visited, so repeated
+    # lookups in the same tree take a single step.
+    # Assumption: companies are not re-parented once the relations are loaded.
+    for company in path:
+        company._root = root_company_id
+
+    return root_company_id
+
+
+@dataclass
+class CompanyTable:
+    """
+    The company tree laid out as parallel columns, indexed by dense integers
+    rather than company ID. Company i is `ids[i]`, named `names[i]`.
+
+    The children of all companies share the one `children_indices` array, in
+    compressed sparse row layout: see `children`. The tree is only described by
+    its children, as a subsidiary may be listed under more than one parent.
+    """
+
+    ids: List[str]
+    names: List[Optional[str]]
+    children_indptr: array
+    children_indices: array
+    id_to_idx: Dict[str, int]
+
+    def children(self, idx: int) -> array:
+        """Get the indices of company `idx`'s children, in their original order."""
+        return self.children_indices[self.children_indptr[idx]:self.children_indptr[idx + 1]]
 
-    if company.parent_id is not None:
-        return get_root_company_id(company.parent_id, companies)
+
+def build_company_table(
+    companies: Mapping[str, Company], root_company_id: Optional[str] = None
+) -> CompanyTable:
+    """
+    Convert a mapping {company_id: Company} into a CompanyTable.
+    If `root_company_id` is given, only that company and its subsidiaries are included,
+    and the rest of the mapping is never looked at.
+    Children are listed in the same order as each company's `children_ids`.
+    """
+    if root_company_id is None:
+        ids = list(companies)
     else:
-        return company_id
+        # Collect the subtree breadth-first (extending `ids` while iterating it visits
+        # the appended children too). A subsidiary with several parents is added once.
+        ids = [root_company_id]
+        seen = {root_company_id}
+        for company_id in ids:
+            for child_id in companies[company_id].children_ids:
+                if child_id not in seen:
+                    seen.add(child_id)
+                    ids.append(child_id)
+
+    id_to_idx = {company_id: idx for idx, company_id in enumerate(ids)}
+    names = []
+    children_indptr = array("i", [0])
+    children_indices = array("i")
+
+    for company_id in ids:
+        company = companies[company_id]
+        names.append(company.name)
+        children_indices.extend(id_to_idx[child_id] for child_id in company.children_ids)
+        children_indptr.append(len(children_indices))
+
+    return CompanyTable(
+        ids=ids,
+        names=names,
+        children_indptr=children_indptr,
+        children_indices=children_indices,
+        id_to_idx=id_to_idx,
+    )
+
+
+def count_parcels(table: CompanyTable, company_land: Mapping[str, List[str]]) -> array:
+    """
+    Count the land parcels each company owns directly, indexed like `table`.
+    Land owned by companies missing from the company relations is ignored.
+    """
+    parcels = array("i", [0]) * len(table.ids)
+
+    # Only land-owning companies need visiting; everyone else stays at 0.
+    for company_id, land_ids in company_land.items():
+        idx = table.id_to_idx.get(company_id)
+        if idx is not None:
+            parcels[idx] = len(land_ids)
+
+    return parcels
+
+
+def get_totals(table: CompanyTable, parcels: Sequence[int]) -> array:
+    """
+    Total the land parcels owned by every company and all of its subsidiaries,
+    indexed like `table`. `parcels[i]` is the number company i owns directly.
+    A subsidiary listed under several parents counts towards each of them.
+    Computing every total up front means any number of trees can then be formatted
+    from the same data without re-summing their subtrees: see `format_table`.
+    Raises ValueError if the children lists contain a cycle (a company owning its
+    own ancestor), whether or not it can be reached from a top-level company.
+    """
+    totals = array("i", parcels)
+    # Per company: 0 = not yet visited, 1 = visiting its subsidiaries, 2 = totalled.
+    state = bytearray(len(table.ids))
+
+    # Depth-first from every company in turn, without recursion. A company is
+    # totalled once all of its children are. The companies still being visited
+    # are exactly the ancestors of the current one, so reaching one of them again
+    # means the walk has found a cycle.
+    for start in range(len(table.ids)):
+        stack = [start]
+        while stack:
+            idx = stack[-1]
+            if state[idx] == 0:
+                state[idx] = 1
+                for child_idx in table.children(idx):
+                    if state[child_idx] == 1:
+                        raise ValueError(
+                            f"Company tree contains a cycle through {table.ids[child_idx]}"
+                        )
+                    if state[child_idx] == 0:
+                        stack.append(child_idx)
+            else:
+                stack.pop()
+                # Skip repeat entries for a company pushed by more than one parent.
+                if state[idx] == 1:
+                    state[idx] = 2
+                    for child_idx in table.children(idx):
+                        totals[idx] += totals[child_idx]
+
+    return totals
 
 
 def format_tree(
@@ -138,49 +306,101 @@ def format_tree(
     """
     Format a company tree for output. Use `root_company_id` as the top of the tree.
     Stop expanding the tree at `target_company_id` (not implemented).
+    Only the companies under `root_company_id` are visited. To format several trees
+    from the same data, build the CompanyTable and its totals once and call
+    `format_table` instead.
     """
-    return _format_node(tree, company_land, root_company_id, target_company_id)[0]
+    table = build_company_table(tree, root_company_id)
+    totals = get_totals(table, count_parcels(table, company_land))
 
+    return format_table(table, totals, root_company_id, target_company_id)
 
-def _format_node(
-    tree: Mapping[str, Company],
-    company_land: Mapping[str, List[str]],
+
+def format_table(
+    table: CompanyTable,
+    totals: Sequence[int],
     root_company_id: str,
     target_company_id: str,
-    level: int = 0,
-) -> Tuple[str, int]:
-    output = ""
-    total_parcels = len(company_land.get(root_company_id, []))
-    company = tree[root_company_id]
-
-    for child_id in company.children_ids:
-        child_output, child_parcels = _format_node(
-            tree, company_land, child_id, target_company_id, level + 1
-        )
-        output += child_output
-        total_parcels += child_parcels
-
-    if level:
-        indent = level * "| " + "- "
-    else:
-        indent = ""
+) -> str:
+    """
+    Format a company tree for output from a CompanyTable and its `totals` (see get_totals).
+    Use `root_company_id` as the top of the tree.
+    Stop expanding the tree at `target_company_id` (not implemented).
+    """
+    order, levels = _walk_tree(table, table.id_to_idx[root_company_id])
 
-    line = (
-        f"{indent}{company.id}; {company.name}; owner of {total_parcels} land parcels"
+    return _format_lines(
+        [table.ids[idx] for idx in order],
+        [table.names[idx] for idx in order],
+        [totals[idx] for idx in order],
+        levels,
     )
-    return f"{line}\n{output}", total_parcels
 
 
-if __name__ == "__main__":
-    import sys
+def _walk_tree(table: CompanyTable, root_idx: int) -> Tuple[List[int], List[int]]:
+    """
+    Walk the tree under `root_idx` depth-first.
+    Returns (order, levels): the companies in pre-order and the level of each.
+    Walks with an explicit stack rather than recursion, so deep trees neither pay for
+    a Python frame per node nor hit the recursion limit.
+    Raises ValueError if the tree contains a cycle (a company owning its own ancestor).
+    """
+    order = []
+    levels = []
+    # The companies between the root and the one being walked. Meeting one of them
+    # again means a cycle. Meeting a company again anywhere else is fine: it is a
+    # subsidiary listed under several parents, or a duplicated row.
+    path = set()
+    # Children are pushed in reverse so they are popped (and therefore printed)
+    # in their original order. Each company also pushes an exit marker (level -1)
+    # beneath its children, which is popped once everything under it is walked.
+    stack = [(root_idx, 0)]
+    while stack:
+        idx, level = stack.pop()
+        if level == -1:
+            path.remove(idx)
+            continue
+        if idx in path:
+            raise ValueError(f"Company tree contains a cycle through {table.ids[idx]}")
+
+        path.add(idx)
+        order.append(idx)
+        levels.append(level)
+        stack.append((idx, -1))
+        stack.extend((child_idx, level + 1) for child_idx in reversed(table.children(idx)))
+
+    return order, levels
+
+
+def _format_lines(
+    ids: Sequence[str],
+    names: Sequence[Optional[str]],
+    totals: Sequence[int],
+    levels: Sequence[int],
+) -> str:
+    """
+    Format one output line per company, given each one's ID, name, total parcels
+    and level in the tree, in the order they should be printed.
+    """
+    # Build each level's indent once per tree, so each line only has to look its
+    # indent up. Kept local: the list is small, and a shared cache would need locking
+    # and would keep the indents of the deepest tree ever seen alive.
+    indents = [""] + [level * "| " + "- " for level in range(1, max(levels) + 1)]
 
-    args = parse_args(sys.argv[1:])
+    # Collect newline-terminated lines and join them once at the end, rather than
+    # growing (and re-copying) one output string.
+    lines = [
+        f"{indents[level]}{company_id}; {name}; owner of {total} land parcels\n"
+        for company_id, name, total, level in zip(ids, names, totals, levels)
+    ]
 
-    with open("land_ownership.csv") as f:
-        company_land = get_land_ownership(f)
+    return "".join(lines)
 
-    with open("company_relations.csv") as f:
-        companies = get_company_relations(f)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+
+    companies, company_land = load_data("company_relations.csv", "land_ownership.csv")
 
     if args.from_ == "root":
         root_company_id = get_root_company_id(args.company_id, companies)
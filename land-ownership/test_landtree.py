@@ -5,8 +5,8 @@
 # pip install -r requirements_dev.txt
 # pytest
 # ```
-import collections
 import io
+import sys
 
 import pytest
 
@@ -57,21 +57,36 @@ def test_parse_args__arg_is_non_optional():
 
 def test_read_csv(land_ownership_file):
     """
-    Unit test: reads CSV data from buffer and returns a generator of the provided type.
-    If you accidentally feed it the CSV's header line, that will end up in the results too.
+    Unit test: reads CSV data from buffer and returns an iterator of rows.
+    Should check and discard the header row.
     """
-    dummy_type = collections.namedtuple("dummy_type", "foo,bar")
+    result = landtree.read_csv(land_ownership_file, ("land_id", "company_id"))
 
-    result = landtree.read_csv(land_ownership_file, dummy_type)
-
-    assert next(result) == dummy_type("land_id", "company_id")
-    assert next(result) == dummy_type("T100018863440", "R590980645905")
-    assert next(result) == dummy_type("T100030485625", "C498567266942")
-    assert next(result) == dummy_type("T10201682101", "R590980645905")
+    assert next(result) == ["T100018863440", "R590980645905"]
+    assert next(result) == ["T100030485625", "C498567266942"]
+    assert next(result) == ["T10201682101", "R590980645905"]
     with pytest.raises(StopIteration):
         next(result)
 
 
+@pytest.mark.parametrize("header", (
+    ("company_id", "land_id"),
+    ("land_id",),
+    ("land_id", "company_id", "name"),
+))
+def test_read_csv__unexpected_header(land_ownership_file, header):
+    """
+    Unit test: refuses CSV data whose header doesn't match the expected columns.
+    """
+    with pytest.raises(ValueError):
+        landtree.read_csv(land_ownership_file, header)
+
+
+def test_read_csv__empty_file():
+    with pytest.raises(ValueError):
+        landtree.read_csv(io.StringIO(""), ("land_id", "company_id"))
+
+
 def test_get_land_ownership(land_ownership_file):
     """
     Unit test: produces company -> land index from CSV data in buffer.
@@ -147,6 +162,35 @@ def test_get_company_relations__top_level_parent_created_indirectly():
     assert result.get(None) is None  # Seems prudent to test for this case too.
 
 
+def test_load_data(tmp_path, land_ownership_file):
+    """
+    Unit test: loads both CSV files from disk.
+    """
+    relations_path = tmp_path / "company_relations.csv"
+    relations_path.write_text("\n".join([
+        "company_id,name,parent",
+        "C498567266942,Cheales lesitech Plc,R590980645905",
+        "R590980645905,Leseetan Group,",
+    ]))
+    land_path = tmp_path / "land_ownership.csv"
+    land_path.write_text(land_ownership_file.getvalue())
+
+    companies, company_land = landtree.load_data(str(relations_path), str(land_path))
+
+    assert companies["R590980645905"].children_ids == ["C498567266942"]
+    assert company_land["R590980645905"] == ["T100018863440", "T10201682101"]
+
+
+def test_company__empty_parent_id():
+    """
+    Unit test: a Company built directly with parent "" is a top-level company.
+    """
+    company = landtree.Company(id="A", parent_id="")
+
+    assert company.parent_id is None
+    assert landtree.get_root_company_id("A", {"A": company}) == "A"
+
+
 @pytest.fixture
 def company_relations():
     return {
@@ -160,6 +204,21 @@ def company_relations():
     }
 
 
+@pytest.fixture
+def deep_company_relations():
+    """A single chain of companies deeper than Python's recursion limit."""
+    depth = sys.getrecursionlimit() + 1
+    return {
+        str(level): landtree.Company(
+            id=str(level),
+            name=f"Company {level}",
+            parent_id=str(level - 1) if level else None,
+            children_ids=[str(level + 1)] if level + 1 < depth else [],
+        )
+        for level in range(depth)
+    }
+
+
 @pytest.mark.parametrize("company_id, expected", (
     ["C", "A"],
     ["B", "A"],
@@ -177,6 +236,113 @@ def test_get_root_company_id(company_id, expected, company_relations):
     assert result == expected
 
 
+def test_get_root_company_id__deep_tree(deep_company_relations):
+    """
+    Unit test: finds the top-level parent in trees deeper than Python's recursion limit.
+    Repeated lookups (which hit the cached root) should give the same answer.
+    """
+    bottom_id = str(len(deep_company_relations) - 1)
+
+    assert landtree.get_root_company_id(bottom_id, deep_company_relations) == "0"
+    assert landtree.get_root_company_id(bottom_id, deep_company_relations) == "0"
+    assert landtree.get_root_company_id("1", deep_company_relations) == "0"
+
+
+def test_build_company_table(company_relations):
+    """
+    Unit test: lays out company data in parallel columns indexed by integers.
+    Children should be listed in the order of their parent's children_ids.
+    Index columns should be stored as compact C int arrays, not lists of Python objects.
+    """
+    result = landtree.build_company_table(company_relations)
+
+    assert result.ids == ["A", "B", "C", "D", "E", "F", "X"]
+    assert result.names[4] == "Company E"
+    assert result.id_to_idx == {"A": 0, "B": 1, "C": 2, "D": 3, "E": 4, "F": 5, "X": 6}
+    assert list(result.children_indptr) == [0, 1, 2, 2, 4, 5, 5, 5]
+    assert list(result.children_indices) == [1, 2, 4, 6, 5]
+    assert list(result.children(3)) == [4, 6]
+    assert list(result.children(6)) == []
+    for column in (result.children_indptr, result.children_indices):
+        assert column.typecode == "i"
+
+
+def test_build_company_table__from_root(company_relations):
+    """
+    Unit test: only includes the root company and its subsidiaries when given a root.
+    """
+    result = landtree.build_company_table(company_relations, root_company_id="D")
+
+    assert result.ids == ["D", "E", "X", "F"]
+    assert list(result.children(0)) == [1, 2]
+    assert list(result.children(1)) == [3]
+
+
+def test_count_parcels(company_relations):
+    """
+    Unit test: counts directly owned land parcels per company, indexed like the company table.
+    Should ignore land owned by companies missing from the company relations.
+    """
+    table = landtree.build_company_table(company_relations)
+    company_land = {
+        "B": ["v", "v"],
+        "X": ["v"],
+        "unknown": ["v"],
+    }
+
+    result = landtree.count_parcels(table, company_land)
+
+    assert list(result) == [0, 2, 0, 0, 0, 0, 1]
+
+
+def test_get_totals(company_relations):
+    """
+    Unit test: totals land parcels owned directly and through subsidiaries, for every company.
+    """
+    table = landtree.build_company_table(company_relations)
+    parcels = [1, 0, 2, 4, 0, 8, 0]
+
+    result = landtree.get_totals(table, parcels)
+
+    assert list(result) == [3, 2, 2, 12, 8, 8, 0]
+
+
+def test_get_totals__shared_subsidiary():
+    """
+    Unit test: a subsidiary listed under two parents counts towards both of them.
+    """
+    company_relations = {
+        "R": landtree.Company(id="R", name="Company R", children_ids=["A", "X"]),
+        "A": landtree.Company(id="A", name="Company A", parent_id="R", children_ids=["B"]),
+        "X": landtree.Company(id="X", name="Company X", parent_id="R", children_ids=["B"]),
+        "B": landtree.Company(id="B", name="Company B", parent_id="X"),
+    }
+    table = landtree.build_company_table(company_relations)
+
+    result = landtree.get_totals(table, [0, 0, 0, 1])
+
+    assert list(result) == [2, 1, 1, 1]
+
+
+def test_format_table(company_relations):
+    """
+    Unit test: formats several trees from one CompanyTable and its totals.
+    """
+    table = landtree.build_company_table(company_relations)
+    totals = landtree.get_totals(table, [1, 0, 2, 4, 0, 8, 0])
+
+    assert landtree.format_table(table, totals, root_company_id="E", target_company_id="E") == "\n".join((
+        "E; Company E; owner of 8 land parcels",
+        "| - F; Company F; owner of 8 land parcels",
+        "",
+    ))
+    assert landtree.format_table(table, totals, root_company_id="B", target_company_id="B") == "\n".join((
+        "B; Company B; owner of 2 land parcels",
+        "| - C; Company C; owner of 2 land parcels",
+        "",
+    ))
+
+
 def test_format_tree(company_relations):
     """
     Unit test: formats company data and land ownership data for output.
@@ -198,3 +364,128 @@ def test_format_tree(company_relations):
         "",
     ))
 
+
+def test_format_tree__ignores_companies_outside_tree():
+    """
+    Unit test: only looks at companies under the root company, so broken references
+    elsewhere in the data don't stop a tree from being formatted.
+    """
+    company_relations = {
+        "A": landtree.Company(id="A", name="Company A", children_ids=["B"]),
+        "B": landtree.Company(id="B", name="Company B", parent_id="A"),
+        "X": landtree.Company(id="X", name="Company X", parent_id="GONE", children_ids=["ALSO_GONE"]),
+    }
+
+    result = landtree.format_tree(company_relations, {"B": ["v"]}, root_company_id="A", target_company_id="A")
+
+    assert result == "\n".join((
+        "A; Company A; owner of 1 land parcels",
+        "| - B; Company B; owner of 1 land parcels",
+        "",
+    ))
+
+
+def test_format_tree__shared_subsidiary():
+    """
+    Unit test: a subsidiary with two parents appears, and is counted, under both.
+    """
+    company_relations_file = io.StringIO("\n".join([
+        "company_id,name,parent",
+        "R,Company R,",
+        "A,Company A,R",
+        "X,Company X,R",
+        "B,Company B,A",
+        "B,Company B,X",
+    ]))
+    company_relations = landtree.get_company_relations(company_relations_file)
+
+    result = landtree.format_tree(company_relations, {"B": ["v"]}, root_company_id="R", target_company_id="R")
+
+    assert result == "\n".join((
+        "R; Company R; owner of 2 land parcels",
+        "| - A; Company A; owner of 1 land parcels",
+        "| | - B; Company B; owner of 1 land parcels",
+        "| - X; Company X; owner of 1 land parcels",
+        "| | - B; Company B; owner of 1 land parcels",
+        "",
+    ))
+
+
+def test_format_tree__duplicate_row():
+    """
+    Unit test: a parent -> child row that appears twice lists (and counts) the child twice.
+    """
+    company_relations_file = io.StringIO("\n".join([
+        "company_id,name,parent",
+        "R,Company R,",
+        "A,Company A,R",
+        "A,Company A,R",
+    ]))
+    company_relations = landtree.get_company_relations(company_relations_file)
+
+    result = landtree.format_tree(company_relations, {"A": ["v"]}, root_company_id="R", target_company_id="R")
+
+    assert result == "\n".join((
+        "R; Company R; owner of 2 land parcels",
+        "| - A; Company A; owner of 1 land parcels",
+        "| - A; Company A; owner of 1 land parcels",
+        "",
+    ))
+
+
+def _format_tree(companies, company_id):
+    return landtree.format_tree(companies, {}, root_company_id=company_id, target_company_id=company_id)
+
+
+def _format_table(companies, company_id):
+    table = landtree.build_company_table(companies)
+    return landtree.format_table(table, [0] * len(table.ids), root_company_id=company_id, target_company_id=company_id)
+
+
+def _get_root_company_id(companies, company_id):
+    return landtree.get_root_company_id(company_id, companies)
+
+
+def _get_totals(companies, company_id):
+    table = landtree.build_company_table(companies)
+    return landtree.get_totals(table, [0] * len(table.ids))
+
+
+@pytest.mark.parametrize("function", (_format_tree, _format_table, _get_root_company_id, _get_totals))
+@pytest.mark.parametrize("rows, company_id, is_cycle", (
+    # Shared subsidiary: B is listed under both A and X. Not a cycle.
+    [["R,,", "A,,R", "X,,R", "B,,A", "B,,X"], "R", False],
+    [["R,,", "A,,R", "X,,R", "B,,A", "B,,X"], "B", False],
+    # A and B own each other, below top-level company R.
+    [["R,,", "A,,R", "B,,A", "A,,B"], "A", True],
+    # A and B own each other, and no top-level company leads to them.
+    [["A,,B", "B,,A"], "A", True],
+))
+def test_cycles(function, rows, company_id, is_cycle):
+    """
+    Unit test: raises ValueError for a company that owns its own ancestor, rather than
+    walking round the cycle forever. Companies reached by more than one path are fine.
+    """
+    company_relations_file = io.StringIO("\n".join(["company_id,name,parent"] + rows))
+    company_relations = landtree.get_company_relations(company_relations_file)
+
+    if is_cycle:
+        with pytest.raises(ValueError):
+            function(company_relations, company_id)
+    else:
+        function(company_relations, company_id)
+
+
+def test_format_tree__deep_tree(deep_company_relations):
+    """
+    Unit test: formats trees deeper than Python's recursion limit.
+    """
+    depth = len(deep_company_relations)
+    company_land = {str(depth - 1): ["v"]}
+
+    result = landtree.format_tree(deep_company_relations, company_land, root_company_id="0", target_company_id="0")
+    lines = result.splitlines()
+
+    assert len(lines) == depth
+    assert lines[0] == "0; Company 0; owner of 1 land parcels"
+    assert lines[-1] == f"{(depth - 1) * '| '}- {depth - 1}; Company {depth - 1}; owner of 1 land parcels"